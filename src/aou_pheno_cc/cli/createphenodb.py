@@ -1,19 +1,23 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import shutil
 import sqlite3
-import subprocess
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Dict, Iterable, Optional
 
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 
 try:
     from google.cloud import bigquery
+    from google.cloud import bigquery_storage
+    from google.cloud import storage
 except Exception as exc:  # pragma: no cover - import error shown at runtime
     bigquery = None
+    bigquery_storage = None
+    storage = None
     _IMPORT_ERROR = exc
 else:
     _IMPORT_ERROR = None
@@ -24,12 +28,25 @@ ANCESTRY_DEFAULT = (
     "ancestry_preds.tsv"
 )
 
+INSERT_CHUNK_ROWS = 10_000
+
+# OMOP.db is a rebuildable cache, so durability is traded for load speed.
+BULK_LOAD_PRAGMAS = [
+    "page_size=65536",
+    "journal_mode=OFF",
+    "synchronous=OFF",
+    "temp_store=MEMORY",
+    "cache_size=-262144",
+    "locking_mode=EXCLUSIVE",
+]
+
 
 def _require_bigquery() -> None:
     if bigquery is None:
         raise RuntimeError(
-            "google-cloud-bigquery is required for createphenodb. "
-            "Install it or run in an environment that has it."
+            "google-cloud-bigquery, google-cloud-bigquery-storage and "
+            "google-cloud-storage are required for createphenodb. "
+            "Install them or run in an environment that has them."
         ) from _IMPORT_ERROR
 
 
@@ -43,23 +60,29 @@ def _sql_queries(dataset_fq: str) -> Dict[str, str]:
 SELECT
     co.person_id,
     co.condition_concept_id,
-    co.condition_start_date
+    MIN(co.condition_start_date) AS min_date,
+    MAX(co.condition_start_date) AS max_date,
+    COUNT(DISTINCT co.condition_start_date) AS n_dates
 FROM `{dataset_fq}.condition_occurrence` co
 JOIN `{dataset_fq}.concept` c
     ON co.condition_concept_id = c.concept_id
 WHERE c.domain_id = 'Condition'
   AND c.standard_concept = 'S'
+GROUP BY co.person_id, co.condition_concept_id
 """.strip(),
         "procedure_occurrence": f"""
 SELECT
     po.person_id,
     po.procedure_concept_id,
-    po.procedure_date
+    MIN(po.procedure_date) AS min_date,
+    MAX(po.procedure_date) AS max_date,
+    COUNT(DISTINCT po.procedure_date) AS n_dates
 FROM `{dataset_fq}.procedure_occurrence` po
 JOIN `{dataset_fq}.concept` c
     ON po.procedure_concept_id = c.concept_id
 WHERE c.domain_id = 'Procedure'
   AND c.standard_concept = 'S'
+GROUP BY po.person_id, po.procedure_concept_id
 """.strip(),
         "condition_descendants": f"""
 SELECT
@@ -124,66 +147,124 @@ FROM `{dataset_fq}.cb_search_person`
     }
 
 
-def _query_to_frames(client: "bigquery.Client", sql: str) -> Iterable[pd.DataFrame]:
-    job = client.query(sql)
-    result = job.result()
-    try:
-        return result.to_dataframe_iterable()
-    except AttributeError:
-        return [result.to_dataframe()]
+def _submit_queries(client: "bigquery.Client", queries: Dict[str, str]) -> Dict[str, "bigquery.QueryJob"]:
+    # client.query returns as soon as the job is created, so all queries run
+    # concurrently in BigQuery while earlier results are written to SQLite.
+    return {name: client.query(sql) for name, sql in queries.items()}
+
+
+def _job_to_batches(
+    job: "bigquery.QueryJob",
+    bqstorage_client: Optional["bigquery_storage.BigQueryReadClient"] = None,
+) -> Iterable[pa.RecordBatch]:
+    # With a read client the result table is downloaded over the Storage API
+    # in Arrow format, one worker thread per server-assigned stream.
+    return job.result().to_arrow_iterable(bqstorage_client=bqstorage_client)
+
+
+def _sqlite_type(arrow_type: pa.DataType) -> str:
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return "REAL"
+    return "TEXT"
+
+
+def _sqlite_column(column: pa.Array) -> list:
+    # sqlite3 has no native date/decimal types; store ISO text and floats.
+    if pa.types.is_temporal(column.type):
+        column = pc.cast(column, pa.string())
+    elif pa.types.is_decimal(column.type):
+        column = pc.cast(column, pa.float64())
+    return column.to_pylist()
+
+
+def _write_tsv_header(tsv_file: pa.NativeFile, schema: pa.Schema) -> None:
+    tsv_file.write(("\t".join(schema.names) + "\n").encode("utf-8"))
+
+
+def _write_tsv_batch(tsv_file: pa.NativeFile, batch: pa.RecordBatch) -> None:
+    # Every string cell is quoted, so the layout never depends on which batch
+    # a row landed in; booleans keep the pandas True/False spelling.
+    columns = [
+        pc.if_else(column, "True", "False") if pa.types.is_boolean(column.type) else column
+        for column in batch.columns
+    ]
+    batch = pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+    write_options = pa_csv.WriteOptions(include_header=False, delimiter="\t", quoting_style="needed")
+    pa_csv.write_csv(batch, tsv_file, write_options=write_options)
 
 
-def _write_frames_to_sqlite(
+def _write_batches_to_sqlite(
     con: sqlite3.Connection,
     name: str,
-    frames: Iterable[pd.DataFrame],
+    batches: Iterable[pa.RecordBatch],
     tsv_path: Optional[Path] = None,
 ) -> None:
-    first = True
-    for frame in frames:
-        if frame.empty:
-            continue
-        frame.to_sql(name, con, if_exists="replace" if first else "append", index=False)
-        if tsv_path is not None:
-            frame.to_csv(
-                tsv_path,
-                sep="\t",
-                index=False,
-                mode="w" if first else "a",
-                header=first,
-            )
-        first = False
-
-
-def _download_ancestry(ancestry_src: str, out_path: Path, project: str) -> Path:
-    if ancestry_src.startswith("gs://"):
-        gsutil = shutil.which("gsutil")
-        if not gsutil:
-            raise RuntimeError(
-                "gsutil not found; provide a local --ancestry-tsv path."
-            )
-        out_path.parent.mkdir(parents=True, exist_ok=True)
-        subprocess.run(
-            [gsutil, "-u", project, "cp", ancestry_src, str(out_path)],
-            check=True,
-        )
-        return out_path
+    insert_sql = None
+    tsv_file = None
+    try:
+        for batch in batches:
+            if insert_sql is None:
+                columns = [f'"{field.name}" {_sqlite_type(field.type)}' for field in batch.schema]
+                con.execute(f'DROP TABLE IF EXISTS "{name}"')
+                con.execute(f'CREATE TABLE "{name}" ({", ".join(columns)})')
+                placeholders = ",".join(["?"] * batch.num_columns)
+                insert_sql = f'INSERT INTO "{name}" VALUES ({placeholders})'
+                if tsv_path is not None:
+                    tsv_file = pa.OSFile(str(tsv_path), "wb")
+                    _write_tsv_header(tsv_file, batch.schema)
+            if batch.num_rows == 0:
+                continue
+            for offset in range(0, batch.num_rows, INSERT_CHUNK_ROWS):
+                chunk = batch.slice(offset, INSERT_CHUNK_ROWS)
+                con.executemany(insert_sql, zip(*[_sqlite_column(col) for col in chunk.columns]))
+            if tsv_file is not None:
+                _write_tsv_batch(tsv_file, batch)
+    finally:
+        if tsv_file is not None:
+            tsv_file.close()
 
-    src_path = Path(ancestry_src)
-    if not src_path.exists():
-        raise FileNotFoundError(f"Ancestry TSV not found: {ancestry_src}")
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    if src_path.resolve() != out_path.resolve():
-        shutil.copy2(src_path, out_path)
-    return out_path
+
+def _read_ancestry(ancestry_src: str, project: str, tsv_path: Optional[Path] = None) -> pa.Table:
+    read_options = {
+        "parse_options": pa_csv.ParseOptions(delimiter="\t"),
+        "convert_options": pa_csv.ConvertOptions(include_columns=["research_id", "ancestry_pred"]),
+    }
+    if ancestry_src.startswith("gs://"):
+        bucket_name, _, blob_name = ancestry_src[len("gs://"):].partition("/")
+        bucket = storage.Client(project=project).bucket(bucket_name, user_project=project)
+        with bucket.blob(blob_name).open("rb") as handle:
+            ancestry = pa_csv.read_csv(handle, **read_options)
+    else:
+        src_path = Path(ancestry_src)
+        if not src_path.exists():
+            raise FileNotFoundError(f"Ancestry TSV not found: {ancestry_src}")
+        ancestry = pa_csv.read_csv(src_path, **read_options)
+
+    ancestry = ancestry.rename_columns(["person_id", "ancestry_pred"])
+    if tsv_path is not None:
+        with pa.OSFile(str(tsv_path), "wb") as tsv_file:
+            _write_tsv_header(tsv_file, ancestry.schema)
+            for batch in ancestry.to_batches():
+                _write_tsv_batch(tsv_file, batch)
+    return ancestry
+
+
+def _join_ancestry(batches: Iterable[pa.RecordBatch], ancestry: pa.Table) -> Iterable[pa.RecordBatch]:
+    for batch in batches:
+        joined = pa.Table.from_batches([batch]).join(ancestry, "person_id", join_type="left outer")
+        yield from joined.combine_chunks().to_batches()
 
 
 def _create_indexes(con: sqlite3.Connection) -> None:
     con.execute(
-        "CREATE INDEX IF NOT EXISTS idx_co_cci ON condition_occurrence(condition_concept_id)"
+        "CREATE INDEX IF NOT EXISTS idx_co_cci_pi "
+        "ON condition_occurrence(condition_concept_id, person_id)"
     )
     con.execute(
-        "CREATE INDEX IF NOT EXISTS idx_po_pci ON procedure_occurrence(procedure_concept_id)"
+        "CREATE INDEX IF NOT EXISTS idx_po_pci_pi "
+        "ON procedure_occurrence(procedure_concept_id, person_id)"
     )
     con.execute(
         "CREATE INDEX IF NOT EXISTS idx_cd_aci ON condition_descendants(ancestor_concept_id)"
@@ -268,38 +349,40 @@ def main() -> int:
     queries = _sql_queries(dataset_fq)
 
     client = bigquery.Client(project=args.project)
+    bqstorage_client = bigquery_storage.BigQueryReadClient()
 
     con = sqlite3.connect(sqlite_path)
+    for pragma in BULK_LOAD_PRAGMAS:
+        con.execute(f"PRAGMA {pragma}")
+    con.execute("BEGIN")
     try:
-        ancestry_path = _download_ancestry(
-            args.ancestry_tsv, out_dir / "ancestry.tsv", args.project
+        print(f"[createphenodb] submitting {len(queries)} queries")
+        jobs = _submit_queries(client, queries)
+
+        print(f"[createphenodb] loading ancestry from {args.ancestry_tsv}")
+        ancestry = _read_ancestry(
+            args.ancestry_tsv,
+            args.project,
+            None if args.no_tsv else out_dir / "ancestry.tsv",
         )
-        print(f"[createphenodb] loading ancestry from {ancestry_path}")
-        ancestry = pd.read_csv(ancestry_path, sep="\t")
-        ancestry = ancestry.rename(columns={"research_id": "person_id"})
-        ancestry = ancestry[["person_id", "ancestry_pred"]]
-
-        for name, sql in queries.items():
-            print(f"[createphenodb] querying {name}...")
-            frames = _query_to_frames(client, sql)
+
+        for name, job in jobs.items():
+            print(f"[createphenodb] waiting for {name}...")
+            batches = _job_to_batches(job, bqstorage_client)
             tsv_path = None if args.no_tsv else out_dir / f"{name}.tsv"
 
             if name == "demographics":
                 print("[createphenodb] merging ancestry into demographics")
-                def _merged_iter():
-                    for frame in frames:
-                        if frame.empty:
-                            continue
-                        yield frame.merge(ancestry, on="person_id", how="left")
-
-                frames = _merged_iter()
+                batches = _join_ancestry(batches, ancestry)
 
             print(f"[createphenodb] writing {name} to sqlite")
-            _write_frames_to_sqlite(con, name, frames, tsv_path)
+            _write_batches_to_sqlite(con, name, batches, tsv_path)
 
         _create_indexes(con)
         print("[createphenodb] creating indexes")
         _write_metadata(con, args.project, dataset_fq, args.ancestry_tsv)
+        con.commit()
+        con.execute("PRAGMA journal_mode=WAL")
         print(f"[createphenodb] done; sqlite at {sqlite_path}")
     finally:
         con.commit()
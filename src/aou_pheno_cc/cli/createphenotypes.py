@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import dataclasses
 import json
 import sqlite3
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
+import numpy as np
 import pandas as pd
 
 
@@ -32,6 +34,15 @@ class PhenotypeDef:
     ctrl_excl_proc: List[int]
 
 
+# Read-side tuning: map the database into memory and give the page cache 512 MiB
+# so the concept_set joins are served from memory after the first touch.
+READ_PRAGMAS = [
+    "mmap_size=34359738368",
+    "cache_size=-524288",
+    "temp_store=MEMORY",
+]
+
+
 def _read_jsonl(path: Path) -> List[PhenotypeDef]:
     phenos: List[PhenotypeDef] = []
     with path.open("r", encoding="utf-8") as handle:
@@ -65,86 +76,231 @@ def _read_jsonl(path: Path) -> List[PhenotypeDef]:
     return phenos
 
 
-def _fetchall_set(cur: sqlite3.Cursor) -> Set[int]:
-    return {row[0] for row in cur.fetchall()}
-
-
-def _icd_to_omop(
-    cur: sqlite3.Cursor,
-    icd_codes: Sequence[str],
-    cache: Dict[Tuple[str, ...], List[int]],
-) -> List[int]:
-    if not icd_codes:
-        return []
-    codes = tuple(sorted({code.strip() for code in icd_codes if str(code).strip()}))
-    if not codes:
-        return []
-    cached = cache.get(codes)
-    if cached is not None:
-        return cached
-    placeholders = ",".join(["?"] * len(codes))
-    sql = f"SELECT DISTINCT omop_concept_id FROM icd2omop WHERE icd_code IN ({placeholders})"
-    cur.execute(sql, list(codes))
-    mapped = [row[0] for row in cur.fetchall()]
-    cache[codes] = mapped
-    return mapped
-
-
-def _descendants(cur: sqlite3.Cursor, table: str, concept_ids: Sequence[int]) -> List[int]:
-    if not concept_ids:
-        return []
-    placeholders = ",".join(["?"] * len(concept_ids))
-    sql = f"SELECT descendant_concept_id FROM {table} WHERE ancestor_concept_id IN ({placeholders})"
-    cur.execute(sql, list(concept_ids))
-    return [row[0] for row in cur.fetchall()]
+def _icd_codes(icd_codes: Sequence[str]) -> Set[str]:
+    return {str(code).strip() for code in icd_codes if str(code).strip()}
+
+
+def _load_icd_map(cur: sqlite3.Cursor, phenos: Sequence[PhenotypeDef]) -> Dict[str, List[int]]:
+    # All ICD codes are resolved with one constant JOIN query, so SQLite compiles
+    # a single statement no matter how many code lists the phenotypes use.
+    codes: Set[str] = set()
+    for pheno in phenos:
+        for icd_codes in (
+            pheno.universe_cond_icd,
+            pheno.universe_excl_cond_icd,
+            pheno.case_cond_icd,
+            pheno.case_excl_cond_icd,
+            pheno.ctrl_excl_cond_icd,
+        ):
+            codes.update(_icd_codes(icd_codes))
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS icd_code_set (code TEXT PRIMARY KEY)")
+    cur.execute("DELETE FROM icd_code_set")
+    cur.executemany("INSERT INTO icd_code_set (code) VALUES (?)", ((code,) for code in codes))
+    cur.execute(
+        "SELECT DISTINCT i.icd_code, i.omop_concept_id FROM icd2omop i "
+        "JOIN icd_code_set s ON i.icd_code = s.code"
+    )
+    icd_map: Dict[str, List[int]] = {}
+    for code, concept_id in cur.fetchall():
+        icd_map.setdefault(code, []).append(concept_id)
+    return icd_map
+
+
+def _icd_to_omop(icd_codes: Sequence[str], icd_map: Dict[str, List[int]]) -> List[int]:
+    mapped: Set[int] = set()
+    for code in _icd_codes(icd_codes):
+        mapped.update(icd_map.get(code, ()))
+    return sorted(mapped)
+
+
+def _resolve_icd(pheno: PhenotypeDef, icd_map: Dict[str, List[int]]) -> PhenotypeDef:
+    return dataclasses.replace(
+        pheno,
+        universe_cond=pheno.universe_cond + _icd_to_omop(pheno.universe_cond_icd, icd_map),
+        universe_excl_cond=pheno.universe_excl_cond
+        + _icd_to_omop(pheno.universe_excl_cond_icd, icd_map),
+        case_cond=pheno.case_cond + _icd_to_omop(pheno.case_cond_icd, icd_map),
+        case_excl_cond=pheno.case_excl_cond + _icd_to_omop(pheno.case_excl_cond_icd, icd_map),
+        ctrl_excl_cond=pheno.ctrl_excl_cond + _icd_to_omop(pheno.ctrl_excl_cond_icd, icd_map),
+    )
 
 
-def _occurrence(
-    cur: sqlite3.Cursor,
+def _stage_concept_set(cur: sqlite3.Cursor, concept_ids: Iterable[int]) -> None:
+    # Indexed temp table joined against instead of long IN (?, ...) lists.
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS concept_set (id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM concept_set")
+    cur.executemany(
+        "INSERT OR IGNORE INTO concept_set (id) VALUES (?)",
+        ((int(concept_id),) for concept_id in concept_ids),
+    )
+
+
+@dataclass
+class OccurrenceTable:
+    person_ids: np.ndarray
+    min_days: np.ndarray
+    member_concepts: np.ndarray
+    member_offsets: np.ndarray
+    ancestor_ids: np.ndarray
+    descendant_offsets: np.ndarray
+    descendant_ids: np.ndarray
+
+
+@dataclass
+class Demographics:
+    person_ids: np.ndarray
+    dob_days: np.ndarray
+
+
+@dataclass
+class OmopData:
+    conditions: OccurrenceTable
+    procedures: OccurrenceTable
+    demographics: Demographics
+
+
+def _load_occurrence_table(
+    con: sqlite3.Connection,
     table: str,
-    concept_ids: Sequence[int],
-    date_col: str,
     descendant_table: str,
-) -> pd.DataFrame:
-    if not concept_ids:
-        return pd.DataFrame(columns=["person_id", "min_date", "max_date", "min_age", "max_age", "n_dates"])
+    concept_ids: Set[int],
+) -> OccurrenceTable:
+    cur = con.cursor()
+    _stage_concept_set(cur, concept_ids)
+    pairs = pd.read_sql_query(
+        f"SELECT d.ancestor_concept_id, d.descendant_concept_id FROM {descendant_table} d "
+        "JOIN concept_set cs ON d.ancestor_concept_id = cs.id "
+        "ORDER BY d.ancestor_concept_id",
+        con,
+    )
 
-    keys = set(concept_ids)
-    keys.update(_descendants(cur, descendant_table, concept_ids))
-    if not keys:
-        return pd.DataFrame(columns=["person_id", "min_date", "max_date", "min_age", "max_age", "n_dates"])
+    # Occurrence tables are pre-aggregated per (person, concept) by createphenodb.
+    _stage_concept_set(cur, concept_ids.union(pairs["descendant_concept_id"].tolist()))
+    concept_col = f"{table.split('_')[0]}_concept_id"
+    occurrences = pd.read_sql_query(
+        f"SELECT o.person_id, o.{concept_col} AS concept_id, o.min_date "
+        f"FROM {table} o JOIN concept_set cs ON o.{concept_col} = cs.id "
+        "WHERE o.min_date IS NOT NULL "
+        f"ORDER BY o.{concept_col}, o.person_id",
+        con,
+    )
+    # Both result sets are sorted by concept, giving CSR-style adjacency: the rows
+    # of keys[i] are offsets[i]:offsets[i + 1].
+    member_concepts, member_offsets = _group_offsets(occurrences["concept_id"])
+    ancestor_ids, descendant_offsets = _group_offsets(pairs["ancestor_concept_id"])
+    return OccurrenceTable(
+        person_ids=occurrences["person_id"].to_numpy(dtype=np.int64),
+        min_days=np.asarray(occurrences["min_date"], dtype="datetime64[D]").view(np.int64),
+        member_concepts=member_concepts,
+        member_offsets=member_offsets,
+        ancestor_ids=ancestor_ids,
+        descendant_offsets=descendant_offsets,
+        descendant_ids=pairs["descendant_concept_id"].to_numpy(dtype=np.int64),
+    )
 
-    placeholders = ",".join(["?"] * len(keys))
-    sql = (
-        f"SELECT person_id, {date_col} FROM {table} "
-        f"WHERE {table.split('_')[0]}_concept_id IN ({placeholders})"
+
+def _load_demographics(con: sqlite3.Connection) -> Demographics:
+    # Sorted person_ids with dates of birth as days since epoch (NaN if unknown).
+    demo = pd.read_sql_query("SELECT person_id, dob FROM demographics ORDER BY person_id", con)
+    dob = pd.to_datetime(demo["dob"]).to_numpy(dtype="datetime64[D]")
+    dob_days = dob.view(np.int64).astype(np.float64)
+    dob_days[np.isnat(dob)] = np.nan
+    return Demographics(person_ids=demo["person_id"].to_numpy(dtype=np.int64), dob_days=dob_days)
+
+
+def _load_omop(con: sqlite3.Connection, phenos: Sequence[PhenotypeDef]) -> OmopData:
+    condition_ids: Set[int] = set()
+    procedure_ids: Set[int] = set()
+    for pheno in phenos:
+        condition_ids.update(pheno.universe_cond, pheno.universe_excl_cond)
+        condition_ids.update(pheno.case_cond, pheno.case_excl_cond, pheno.ctrl_excl_cond)
+        procedure_ids.update(pheno.universe_proc, pheno.universe_excl_proc)
+        procedure_ids.update(pheno.case_proc, pheno.case_excl_proc, pheno.ctrl_excl_proc)
+    return OmopData(
+        conditions=_load_occurrence_table(
+            con, "condition_occurrence", "condition_descendants", condition_ids
+        ),
+        procedures=_load_occurrence_table(
+            con, "procedure_occurrence", "procedure_descendants", procedure_ids
+        ),
+        demographics=_load_demographics(con),
     )
-    cur.execute(sql, list(keys))
-    rows = cur.fetchall()
-    if not rows:
-        return pd.DataFrame(columns=["person_id", "min_date", "max_date", "min_age", "max_age", "n_dates"])
-
-    df = pd.DataFrame(rows, columns=["person_id", "date"])
-    df["date"] = pd.to_datetime(df["date"])
-
-    demo = pd.read_sql_query("SELECT person_id, dob FROM demographics", cur.connection)
-    demo["dob"] = pd.to_datetime(demo["dob"])
-
-    grouped = (
-        df.dropna()
-        .groupby(["person_id", "date"], as_index=False)
-        .size()
-        .groupby("person_id")
-        .agg(min_date=("date", "min"), max_date=("date", "max"), n_dates=("size", "count"))
-        .reset_index()
+
+
+def _lookup(sorted_ids: np.ndarray, ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+    # Positions of ids in sorted_ids, and whether each id was found there.
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    ix = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return ix, sorted_ids[ix] == ids
+
+
+def _person_mask(person_ids: np.ndarray, ids: Iterable[int]) -> np.ndarray:
+    ix, found = _lookup(person_ids, ids)
+    mask = np.zeros(len(person_ids), dtype=bool)
+    mask[ix[found]] = True
+    return mask
+
+
+def _dob_days(demographics: Demographics, person_ids: np.ndarray) -> np.ndarray:
+    ix, found = _lookup(demographics.person_ids, person_ids)
+    dob_days = np.full(len(person_ids), np.nan)
+    dob_days[found] = demographics.dob_days[ix[found]]
+    return dob_days
+
+
+def _group_offsets(sorted_keys: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+    sorted_keys = np.asarray(sorted_keys, dtype=np.int64)
+    keys, starts = np.unique(sorted_keys, return_index=True)
+    return keys, np.r_[starts, len(sorted_keys)].astype(np.int64)
+
+
+def _group_rows(keys: np.ndarray, offsets: np.ndarray, ids: Iterable[int]) -> np.ndarray:
+    # Concatenated row ranges of every id found in keys, without a Python loop.
+    ix, found = _lookup(keys, ids)
+    ix = ix[found]
+    starts = offsets[ix]
+    lengths = offsets[ix + 1] - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def _descendants(table: OccurrenceTable, concept_ids: Sequence[int]) -> np.ndarray:
+    rows = _group_rows(table.ancestor_ids, table.descendant_offsets, concept_ids)
+    return np.union1d(np.asarray(concept_ids, dtype=np.int64), table.descendant_ids[rows])
+
+
+def _occurrence(
+    table: OccurrenceTable,
+    concept_ids: Sequence[int],
+    demographics: Demographics,
+) -> pd.DataFrame:
+    if not concept_ids:
+        return pd.DataFrame(columns=["person_id", "min_date", "min_age"])
+
+    keys = _descendants(table, concept_ids)
+    rows = _group_rows(table.member_concepts, table.member_offsets, keys)
+    if not len(rows):
+        return pd.DataFrame(columns=["person_id", "min_date", "min_age"])
+
+    # One stable sort by person, then per-person reductions over each run.
+    order = rows[np.argsort(table.person_ids[rows], kind="stable")]
+    person_ids = table.person_ids[order]
+    starts = np.flatnonzero(np.r_[True, person_ids[1:] != person_ids[:-1]])
+    min_days = np.minimum.reduceat(table.min_days[order], starts)
+
+    person_ids = person_ids[starts]
+    dob_days = _dob_days(demographics, person_ids)
+    return pd.DataFrame(
+        {
+            "person_id": person_ids,
+            "min_date": min_days.astype("datetime64[D]"),
+            "min_age": (min_days - dob_days) / 365.25,
+        }
     )
-    merged = grouped.merge(demo, on="person_id", how="left")
-    merged["min_age"] = (merged["min_date"] - merged["dob"]).dt.days / 365.25
-    merged["max_age"] = (merged["max_date"] - merged["dob"]).dt.days / 365.25
-    return merged[["person_id", "min_date", "max_date", "min_age", "max_age", "n_dates"]]
 
 
-def _universe(cur: sqlite3.Cursor) -> Set[int]:
+def _universe(cur: sqlite3.Cursor) -> np.ndarray:
     sql = (
         "SELECT person_id FROM demographics "
         "WHERE sex_at_birth IN ('Male','Female') "
@@ -152,118 +308,115 @@ def _universe(cur: sqlite3.Cursor) -> Set[int]:
         "AND ancestry_pred IS NOT NULL"
     )
     cur.execute(sql)
-    return _fetchall_set(cur)
+    return np.unique(np.fromiter((row[0] for row in cur), dtype=np.int64))
+
+
+def _occurrence_mask(
+    omop: OmopData,
+    table: OccurrenceTable,
+    concept_ids: Sequence[int],
+    person_ids: np.ndarray,
+) -> np.ndarray:
+    return _person_mask(person_ids, _occurrence(table, concept_ids, omop.demographics)["person_id"])
 
 
 def _apply_universe_filters(
-    cur: sqlite3.Cursor,
-    universe: Set[int],
+    omop: OmopData,
+    person_ids: np.ndarray,
+    universe: np.ndarray,
     cond: Sequence[int],
     proc: Sequence[int],
     excl_cond: Sequence[int],
     excl_proc: Sequence[int],
-) -> Set[int]:
-    if not (cond or proc or excl_cond or excl_proc):
-        return universe
-
+) -> np.ndarray:
     if cond:
-        co = _occurrence(cur, "condition_occurrence", cond, "condition_start_date", "condition_descendants")
-        universe = universe.intersection(set(co["person_id"]))
+        universe = universe & _occurrence_mask(omop, omop.conditions, cond, person_ids)
     if proc:
-        po = _occurrence(cur, "procedure_occurrence", proc, "procedure_date", "procedure_descendants")
-        universe = universe.intersection(set(po["person_id"]))
+        universe = universe & _occurrence_mask(omop, omop.procedures, proc, person_ids)
 
     if excl_cond:
-        co_ex = _occurrence(cur, "condition_occurrence", excl_cond, "condition_start_date", "condition_descendants")
-        universe = universe.difference(set(co_ex["person_id"]))
+        universe = universe & ~_occurrence_mask(omop, omop.conditions, excl_cond, person_ids)
     if excl_proc:
-        po_ex = _occurrence(cur, "procedure_occurrence", excl_proc, "procedure_date", "procedure_descendants")
-        universe = universe.difference(set(po_ex["person_id"]))
+        universe = universe & ~_occurrence_mask(omop, omop.procedures, excl_proc, person_ids)
 
     return universe
 
 
 def _get_case_control(
-    cur: sqlite3.Cursor,
-    universe: Set[int],
+    omop: OmopData,
+    person_ids: np.ndarray,
+    universe: np.ndarray,
     pheno: PhenotypeDef,
-    case_cond: Sequence[int],
-    case_excl_cond: Sequence[int],
-    ctrl_excl_cond: Sequence[int],
-) -> Tuple[Set[int], Set[int]]:
-    co = _occurrence(cur, "condition_occurrence", case_cond, "condition_start_date", "condition_descendants")
-    po = _occurrence(cur, "procedure_occurrence", pheno.case_proc, "procedure_date", "procedure_descendants")
-
-    case_ids = set(co["person_id"]).union(set(po["person_id"]))
-    cases_0 = universe.intersection(case_ids)
-    controls_0 = universe.difference(cases_0)
-
-    frames = [frame for frame in (co, po) if not frame.empty]
-    combined = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
-    if not combined.empty:
-        combined = (
-            combined.groupby("person_id", as_index=False)
-            .agg(age_at_first_diagnosis=("min_age", "min"))
-        )
-        min_age = pheno.case_min_age if pheno.case_min_age is not None else 0.0
-        max_age = pheno.case_max_age if pheno.case_max_age is not None else float("inf")
-        age_ok = combined[
-            (combined["age_at_first_diagnosis"] >= min_age)
-            & (combined["age_at_first_diagnosis"] <= max_age)
-        ]
-        cases_age = set(age_ok["person_id"])
-    else:
-        cases_age = set()
-
-    cases = universe.intersection(cases_age)
-
-    if case_excl_cond:
-        co_ex = _occurrence(
-            cur,
-            "condition_occurrence",
-            case_excl_cond,
-            "condition_start_date",
-            "condition_descendants",
-        )
-        cases = cases.difference(set(co_ex["person_id"]))
+) -> Tuple[np.ndarray, np.ndarray]:
+    co = _occurrence(omop.conditions, pheno.case_cond, omop.demographics)
+    po = _occurrence(omop.procedures, pheno.case_proc, omop.demographics)
+
+    cases_0 = universe & (_person_mask(person_ids, co["person_id"]) | _person_mask(person_ids, po["person_id"]))
+    controls_0 = universe & ~cases_0
+
+    age_at_first_diagnosis = np.full(len(person_ids), np.nan)
+    for frame in (co, po):
+        ix, found = _lookup(person_ids, frame["person_id"])
+        np.fmin.at(age_at_first_diagnosis, ix[found], frame["min_age"].to_numpy(dtype=np.float64)[found])
+    min_age = pheno.case_min_age if pheno.case_min_age is not None else 0.0
+    max_age = pheno.case_max_age if pheno.case_max_age is not None else float("inf")
+    age_ok = (age_at_first_diagnosis >= min_age) & (age_at_first_diagnosis <= max_age)
+
+    cases = universe & age_ok
+
+    if pheno.case_excl_cond:
+        cases &= ~_occurrence_mask(omop, omop.conditions, pheno.case_excl_cond, person_ids)
     if pheno.case_excl_proc:
-        po_ex = _occurrence(
-            cur,
-            "procedure_occurrence",
-            pheno.case_excl_proc,
-            "procedure_date",
-            "procedure_descendants",
-        )
-        cases = cases.difference(set(po_ex["person_id"]))
+        cases &= ~_occurrence_mask(omop, omop.procedures, pheno.case_excl_proc, person_ids)
 
     controls = controls_0
-    if ctrl_excl_cond:
-        co_ex = _occurrence(
-            cur,
-            "condition_occurrence",
-            ctrl_excl_cond,
-            "condition_start_date",
-            "condition_descendants",
-        )
-        controls = controls.difference(set(co_ex["person_id"]))
+    if pheno.ctrl_excl_cond:
+        controls &= ~_occurrence_mask(omop, omop.conditions, pheno.ctrl_excl_cond, person_ids)
     if pheno.ctrl_excl_proc:
-        po_ex = _occurrence(
-            cur,
-            "procedure_occurrence",
-            pheno.ctrl_excl_proc,
-            "procedure_date",
-            "procedure_descendants",
-        )
-        controls = controls.difference(set(po_ex["person_id"]))
+        controls &= ~_occurrence_mask(omop, omop.procedures, pheno.ctrl_excl_proc, person_ids)
 
     return cases, controls
 
 
-def _add_pheno_column(df: pd.DataFrame, cases: Set[int], controls: Set[int], label: str) -> pd.DataFrame:
-    df[label] = pd.Series(pd.NA, index=df.index, dtype="Int64")
-    df.loc[df["person_id"].isin(cases), label] = 1
-    df.loc[df["person_id"].isin(controls), label] = 0
-    return df
+def _pheno_columns(matrix: np.ndarray, labels: Sequence[str], index: pd.Index) -> pd.DataFrame:
+    # matrix holds 1 (case), 0 (control) or -1 (neither, written as NA).
+    columns = {
+        label: pd.arrays.IntegerArray(matrix[:, j], mask=matrix[:, j] < 0)
+        for j, label in enumerate(labels)
+    }
+    return pd.DataFrame(columns, index=index)
+
+
+def _ancestry_counts(
+    matrix: np.ndarray,
+    ancestry: pd.Series,
+    labels: Sequence[str],
+) -> List[Dict[str, object]]:
+    # One pass over the phenotype matrix per ancestry group, for all phenotypes.
+    codes, ancestries = pd.factorize(ancestry, sort=True)
+    case_counts = np.zeros((len(ancestries), len(labels)), dtype=np.int64)
+    control_counts = np.zeros((len(ancestries), len(labels)), dtype=np.int64)
+    for a in range(len(ancestries)):
+        group = matrix[codes == a]
+        case_counts[a] = (group == 1).sum(axis=0)
+        control_counts[a] = (group == 0).sum(axis=0)
+
+    counts_rows: List[Dict[str, object]] = []
+    for j, label in enumerate(labels):
+        for a, ancestry_name in enumerate(ancestries):
+            ncases = int(case_counts[a, j])
+            ncontrols = int(control_counts[a, j])
+            if ncases == 0 and ncontrols == 0:
+                continue
+            counts_rows.append(
+                {
+                    "phenotype_id": label,
+                    "ancestry": ancestry_name,
+                    "ncases": "<20" if ncases < 20 else ncases,
+                    "ncontrols": "<20" if ncontrols < 20 else ncontrols,
+                }
+            )
+    return counts_rows
 
 
 def main() -> int:
@@ -291,72 +444,48 @@ def main() -> int:
 
     con = sqlite3.connect(args.sqlite)
     try:
+        for pragma in READ_PRAGMAS:
+            con.execute(f"PRAGMA {pragma}")
         cur = con.cursor()
-        base_universe = _universe(cur)
-        icd_cache: Dict[Tuple[str, ...], List[int]] = {}
+        person_ids = _universe(cur)
+        icd_map = _load_icd_map(cur, phenos)
+        phenos = [_resolve_icd(pheno, icd_map) for pheno in phenos]
+        omop = _load_omop(con, phenos)
 
-        df = pd.DataFrame({"person_id": sorted(base_universe)})
+        base_mask = np.ones(len(person_ids), dtype=bool)
+        df = pd.DataFrame({"person_id": person_ids})
         demo = pd.read_sql_query(
             "SELECT person_id, ancestry_pred FROM demographics",
             con,
         )
-        demo = demo[demo["person_id"].isin(base_universe)]
+        demo = demo[np.isin(demo["person_id"].to_numpy(dtype=np.int64), person_ids)]
+        # Duplicated ancestry rows would make the merge longer than the matrix.
+        demo = demo.drop_duplicates("person_id")
         demo["ancestry_pred"] = demo["ancestry_pred"].fillna("NA").astype(str)
         ancestry_df = df.merge(demo, on="person_id", how="left")
         ancestry_df["ancestry"] = ancestry_df["ancestry_pred"].fillna("NA")
         ancestry_df = ancestry_df[["person_id", "ancestry"]]
-        counts_rows: List[Dict[str, object]] = []
+        matrix = np.full((len(person_ids), len(phenos)), -1, dtype=np.int8, order="F")
 
-        for pheno in phenos:
-            universe_cond = pheno.universe_cond + _icd_to_omop(
-                cur, pheno.universe_cond_icd, icd_cache
-            )
-            universe_excl_cond = pheno.universe_excl_cond + _icd_to_omop(
-                cur, pheno.universe_excl_cond_icd, icd_cache
-            )
-            case_cond = pheno.case_cond + _icd_to_omop(
-                cur, pheno.case_cond_icd, icd_cache
-            )
-            case_excl_cond = pheno.case_excl_cond + _icd_to_omop(
-                cur, pheno.case_excl_cond_icd, icd_cache
-            )
-            ctrl_excl_cond = pheno.ctrl_excl_cond + _icd_to_omop(
-                cur, pheno.ctrl_excl_cond_icd, icd_cache
-            )
+        for j, pheno in enumerate(phenos):
             universe = _apply_universe_filters(
-                cur,
-                base_universe,
-                universe_cond,
+                omop,
+                person_ids,
+                base_mask,
+                pheno.universe_cond,
                 pheno.universe_proc,
-                universe_excl_cond,
+                pheno.universe_excl_cond,
                 pheno.universe_excl_proc,
             )
-            cases, controls = _get_case_control(
-                cur,
-                universe,
-                pheno,
-                case_cond,
-                case_excl_cond,
-                ctrl_excl_cond,
-            )
-            df = _add_pheno_column(df, cases, controls, pheno.phenotype_id)
-            case_counts = ancestry_df[ancestry_df["person_id"].isin(cases)].groupby("ancestry").size()
-            control_counts = ancestry_df[ancestry_df["person_id"].isin(controls)].groupby("ancestry").size()
-            ancestries = sorted(set(case_counts.index).union(control_counts.index))
-            for ancestry in ancestries:
-                ncases = int(case_counts.get(ancestry, 0))
-                ncontrols = int(control_counts.get(ancestry, 0))
-                counts_rows.append(
-                    {
-                        "phenotype_id": pheno.phenotype_id,
-                        "ancestry": ancestry,
-                        "ncases": "<20" if ncases < 20 else ncases,
-                        "ncontrols": "<20" if ncontrols < 20 else ncontrols,
-                    }
-                )
+            cases, controls = _get_case_control(omop, person_ids, universe, pheno)
+            matrix[cases, j] = 1
+            matrix[controls, j] = 0
     finally:
         con.close()
 
+    labels = [pheno.phenotype_id for pheno in phenos]
+    counts_rows = _ancestry_counts(matrix, ancestry_df["ancestry"], labels)
+    df = pd.concat([df, _pheno_columns(matrix, labels, df.index)], axis=1)
     output_path = Path(args.output) if args.output else phenotypes_path.with_suffix(".tsv")
     df.to_csv(output_path, sep="\t", index=False, na_rep="NA")
     counts_path = (
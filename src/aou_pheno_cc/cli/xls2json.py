@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import compress, islice, zip_longest
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import pandas as pd
+from openpyxl import load_workbook
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    orjson = None
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # pragma: no cover - openpyxl fallback
+    CalamineWorkbook = None
 
 
 REQUIRED_COLUMNS = [
@@ -32,9 +49,11 @@ OPTIONAL_COLUMNS = [
     "ctrl.excl.proc",
 ]
 
-ALLOWED_COLUMNS = set(REQUIRED_COLUMNS) | set(OPTIONAL_COLUMNS)
+ALL_COLUMNS = tuple(REQUIRED_COLUMNS) + tuple(OPTIONAL_COLUMNS)
+
+ALLOWED_COLUMNS = frozenset(ALL_COLUMNS)
 
-CONCEPT_LIST_COLUMNS = {
+CONCEPT_LIST_COLUMNS = frozenset({
     "universe.cond",
     "universe.proc",
     "universe.excl.cond",
@@ -45,85 +64,267 @@ CONCEPT_LIST_COLUMNS = {
     "case.excl.proc",
     "ctrl.excl.cond",
     "ctrl.excl.proc",
-}
+})
 
-ICD_LIST_COLUMNS = {
+ICD_LIST_COLUMNS = frozenset({
     "universe.cond.icd",
     "universe.excl.cond.icd",
     "case.cond.icd",
     "case.excl.cond.icd",
     "ctrl.excl.cond.icd",
+})
+
+LIST_COLUMNS = CONCEPT_LIST_COLUMNS | ICD_LIST_COLUMNS
+
+AGE_COLUMNS = frozenset({"case.min.age", "case.max.age"})
+
+# Columns passed to _validate_columns, in its argument order.
+VALIDATED_COLUMNS = ("phenotype_id", "phenotype_name", "case.cond", "case.cond.icd")
+
+CHUNK_ROWS = 10_000
+
+# pandas' default NA tokens; pd.read_excel read these cells as missing.
+NA_VALUES = frozenset({
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+})
+
+_COMMA_SPLIT_RE = re.compile(r"\s*,\s*")
+
+
+def _dumps(record: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(record)
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _normalize_column(values: Any, col: str, row_numbers: List[int]) -> pd.Series:
+    text = pd.Series(values, index=row_numbers, name=col, dtype=object)
+    text = text.astype("string").str.strip()
+    return text.where(~text.isin(NA_VALUES))
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and value.strip() in NA_VALUES)
+
+
+def _to_objects(series: pd.Series) -> List[Any]:
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _split_cell(value: str) -> List[str]:
+    # Cells are already stripped, so one regex split yields clean items.
+    return [item for item in _COMMA_SPLIT_RE.split(value) if item]
+
+
+# Cell values repeat heavily across phenotypes; parse each distinct text once.
+# Tuples keep the cached results immutable and serialize as JSON arrays.
+@lru_cache(maxsize=4096)
+def _parse_icd_cell(value: str) -> Tuple[str, ...]:
+    return tuple(_split_cell(value))
+
+
+@lru_cache(maxsize=4096)
+def _parse_concept_cell(value: str) -> Tuple[int, ...]:
+    return tuple(map(int, _split_cell(value)))
+
+
+def _parse_icd_column(text: pd.Series) -> List[Tuple[str, ...]]:
+    return [() if value is None else _parse_icd_cell(value) for value in _to_objects(text)]
+
+
+def _parse_concept_column(text: pd.Series) -> List[Tuple[int, ...]]:
+    # Validate every token of the column at once and report all bad rows;
+    # cells can then be converted without per-token checks.
+    tokens = text.str.split(_COMMA_SPLIT_RE.pattern, regex=True).explode()
+    tokens = tokens[tokens.notna() & (tokens != "")].astype("string")
+    invalid = tokens[~tokens.str.fullmatch(r"\d+")]
+    if not invalid.empty:
+        rows = ", ".join(str(row) for row in invalid.index.unique())
+        values = ", ".join(f"'{value}'" for value in invalid.unique())
+        raise ValueError(
+            f"Invalid concept ids in column {text.name} (rows {rows}): {values}. "
+            "Only numeric OMOP concept IDs are supported."
+        )
+    return [() if value is None else _parse_concept_cell(value) for value in _to_objects(text)]
+
+
+def _parse_age_column(text: pd.Series) -> List[Optional[float]]:
+    ages = pd.to_numeric(text, errors="coerce")
+    invalid = text[text.notna() & ages.isna()]
+    if not invalid.empty:
+        raise ValueError(f"Invalid age value '{invalid.iloc[0]}'")
+    # NaN is the only float unequal to itself; avoids a pd.isna call per cell.
+    values = ages.to_numpy(dtype=float, na_value=float("nan")).tolist()
+    return [None if age != age else age for age in values]
+
+
+COL_PARSER: Dict[str, Callable[[pd.Series], List[Any]]] = {
+    **{col: _parse_concept_column for col in CONCEPT_LIST_COLUMNS},
+    **{col: _parse_icd_column for col in ICD_LIST_COLUMNS},
+    **{col: _parse_age_column for col in AGE_COLUMNS},
 }
 
-AGE_COLUMNS = {"case.min.age", "case.max.age"}
 
+def _check_columns(columns: Any) -> None:
+    missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing:
+        raise ValueError(f"Missing required columns: {', '.join(missing)}")
+    extra = [col for col in columns if col not in ALLOWED_COLUMNS]
+    if extra:
+        raise ValueError(f"Unknown columns: {', '.join(extra)}")
+    duplicated = [col for col, count in Counter(columns).items() if count > 1]
+    if duplicated:
+        raise ValueError(f"Duplicate columns: {', '.join(duplicated)}")
+
+
+ParseStep = Tuple[str, Optional[int], Callable[[pd.Series], List[Any]]]
 
-def _normalize_cell(value: Any) -> Optional[str]:
-    if value is None:
-        return None
-    if isinstance(value, float) and pd.isna(value):
-        return None
-    text = str(value).strip()
-    return text if text else None
-
-
-def _parse_concept_list(value: Any) -> List[int]:
-    text = _normalize_cell(value)
-    if text is None:
-        return []
-    parts = [p.strip() for p in text.split(",") if p.strip()]
-    ids: List[int] = []
-    for part in parts:
-        if not part.isdigit():
-            raise ValueError(
-                f"Invalid concept id '{part}'. Only numeric OMOP concept IDs are supported."
-            )
-        ids.append(int(part))
-    return ids
-
-
-def _parse_icd_list(value: Any) -> List[str]:
-    text = _normalize_cell(value)
-    if text is None:
-        return []
-    return [part.strip() for part in text.split(",") if part.strip()]
-
-
-def _parse_age(value: Any) -> Optional[float]:
-    text = _normalize_cell(value)
-    if text is None:
+
+def _calamine_cell(value: Any) -> Any:
+    # Match openpyxl: empty cells are None, integral numbers are ints and
+    # date cells are datetimes.
+    if value == "":
         return None
-    try:
-        return float(text)
-    except ValueError as exc:
-        raise ValueError(f"Invalid age value '{text}'") from exc
-
-
-def _row_to_record(row: pd.Series) -> Dict[str, Any]:
-    record: Dict[str, Any] = {}
-    for col in REQUIRED_COLUMNS + OPTIONAL_COLUMNS:
-        if col in CONCEPT_LIST_COLUMNS:
-            record[col] = _parse_concept_list(row.get(col))
-        elif col in ICD_LIST_COLUMNS:
-            record[col] = _parse_icd_list(row.get(col))
-        elif col in AGE_COLUMNS:
-            record[col] = _parse_age(row.get(col))
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    return value
+
+
+def _iter_rows(input_path: Path, sheet: Any) -> Iterator[Tuple[Any, ...]]:
+    if CalamineWorkbook is not None:
+        workbook = CalamineWorkbook.from_path(str(input_path))
+        if isinstance(sheet, str):
+            worksheet = workbook.get_sheet_by_name(sheet)
         else:
-            record[col] = _normalize_cell(row.get(col))
-    if not record["phenotype_id"]:
-        raise ValueError("Missing phenotype_id")
-    if not record["phenotype_name"]:
-        raise ValueError(f"Missing phenotype_name for {record['phenotype_id']}")
-    if not (record["case.cond"] or record["case.cond.icd"]):
-        raise ValueError(
-            f"Missing case.cond or case.cond.icd for {record['phenotype_id']}"
-        )
-    return record
+            worksheet = workbook.get_sheet_by_index(sheet)
+        for row in worksheet.iter_rows():
+            yield tuple(_calamine_cell(value) for value in row)
+        return
+
+    # Read-only mode streams cells from the XML instead of building the full
+    # workbook object model.
+    workbook = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if isinstance(sheet, str) else workbook.worksheets[sheet]
+        yield from worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _parse_plan(header: Tuple[Any, ...]) -> List[ParseStep]:
+    # Resolve each output column to its sheet position and parser once per
+    # sheet; absent columns have no position.
+    col_idx = {str(name): idx for idx, name in enumerate(header) if name is not None}
+    return [(col, col_idx.get(col), COL_PARSER.get(col, _to_objects)) for col in ALL_COLUMNS]
+
+
+def _chunk_cells(header: Tuple[Any, ...], chunk: List[Tuple[Any, ...]]) -> List[Sequence[Any]]:
+    # Transpose the raw rows into columns; no DataFrame is built.
+    cells = list(zip_longest(*chunk))
+    cells += [(None,) * len(chunk)] * (len(header) - len(cells))
+    # Headerless columns that hold data only show up once rows are read.
+    unnamed = [
+        f"Unnamed: {idx}"
+        for idx, values in enumerate(cells)
+        if (idx >= len(header) or header[idx] is None)
+        and any(value is not None for value in values)
+    ]
+    if unnamed:
+        raise ValueError(f"Unknown columns: {', '.join(unnamed)}")
+    return cells
+
+
+def _parse_columns(
+    plan: List[ParseStep],
+    cells: List[Sequence[Any]],
+    keep: List[bool],
+    row_numbers: List[int],
+    map_fn: Callable[..., Iterator[Any]] = map,
+) -> List[List[Any]]:
+    n_rows = len(row_numbers)
+
+    def parse_step(step: ParseStep) -> List[Any]:
+        col, idx, parse = step
+        if idx is not None:
+            values = list(compress(cells[idx], keep))
+            return parse(_normalize_column(values, col, row_numbers))
+        if col in LIST_COLUMNS:
+            # Columns absent from the sheet parse to constants; skip the kernels.
+            return [()] * n_rows
+        return [None] * n_rows
+
+    # Columns are independent, so map_fn may run them on a thread pool;
+    # results come back in plan order either way.
+    return list(map_fn(parse_step, plan))
+
+
+def _iter_records(
+    header: Tuple[Any, ...],
+    rows: Iterator[Tuple[Any, ...]],
+    map_fn: Callable[..., Iterator[Any]] = map,
+) -> Iterator[Dict[str, Any]]:
+    plan = _parse_plan(header)
+    names = [col for col, _, _ in plan]
+    positions = {col: idx for col, idx, _ in plan}
+    id_idx, name_idx = positions["phenotype_id"], positions["phenotype_name"]
+
+    # Parse CHUNK_ROWS rows at a time so memory stays flat for large sheets.
+    first_row = 2  # sheet row number of the first data row, after the header
+    while True:
+        chunk = list(islice(rows, CHUNK_ROWS))
+        if not chunk:
+            return
+        row_numbers = range(first_row, first_row + len(chunk))
+        first_row += len(chunk)
+        cells = _chunk_cells(header, chunk)
+        keep = [
+            not (_is_missing(phenotype_id) and _is_missing(phenotype_name))
+            for phenotype_id, phenotype_name in zip(cells[id_idx], cells[name_idx])
+        ]
+        parsed = _parse_columns(plan, cells, keep, list(compress(row_numbers, keep)), map_fn)
+        _validate_columns(*(parsed[names.index(col)] for col in VALIDATED_COLUMNS))
+        for values in zip(*parsed):
+            yield dict(zip(names, values))
+
+
+def _validate_columns(
+    phenotype_ids: List[Any], phenotype_names: List[Any], conds: List[Any], icds: List[Any]
+) -> None:
+    for phenotype_id, phenotype_name, cond, icd in zip(phenotype_ids, phenotype_names, conds, icds):
+        if not phenotype_id:
+            raise ValueError("Missing phenotype_id")
+        if not phenotype_name:
+            raise ValueError(f"Missing phenotype_name for {phenotype_id}")
+        if not (cond or icd):
+            raise ValueError(f"Missing case.cond or case.cond.icd for {phenotype_id}")
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(
-        description="Convert phenotype definition Excel file to JSONL."
+        description=(
+            "Convert phenotype definition Excel file to JSONL. The sheet is read "
+            "with python-calamine when installed (much faster), otherwise openpyxl."
+        )
     )
     parser.add_argument("input", help="Path to .xlsx file")
     parser.add_argument(
@@ -138,7 +339,16 @@ def main() -> int:
         default=None,
         help="Output .jsonl path (default: input filename with .jsonl)",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Threads used to parse the columns of each chunk (default: 1)",
+    )
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
     input_path = Path(args.input)
     if not input_path.exists():
@@ -148,23 +358,29 @@ def main() -> int:
     if isinstance(sheet, str) and sheet.isdigit():
         sheet = int(sheet)
 
-    df = pd.read_excel(input_path, sheet_name=sheet, engine="openpyxl")
-
-    missing = [col for col in REQUIRED_COLUMNS if col not in df.columns]
-    if missing:
-        raise ValueError(f"Missing required columns: {', '.join(missing)}")
-    extra = [col for col in df.columns if col not in ALLOWED_COLUMNS]
-    if extra:
-        raise ValueError(f"Unknown columns: {', '.join(extra)}")
-
     output_path = Path(args.output) if args.output else input_path.with_suffix(".jsonl")
 
-    with output_path.open("w", encoding="utf-8") as handle:
-        for _, row in df.iterrows():
-            if pd.isna(row.get("phenotype_id")) and pd.isna(row.get("phenotype_name")):
-                continue
-            record = _row_to_record(row)
-            handle.write(json.dumps(record, ensure_ascii=True) + "\n")
+    executor = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    map_fn = executor.map if executor is not None else map
+    rows = _iter_rows(input_path, sheet)
+    try:
+        header = next(rows, ())
+        # Fail on bad headers before streaming the data rows.
+        _check_columns([str(name) for name in header if name is not None])
+
+        with output_path.open("wb", buffering=1 << 20) as handle:
+            lines: List[bytes] = []
+            for record in _iter_records(header, rows, map_fn):
+                lines.append(_dumps(record))
+                if len(lines) >= CHUNK_ROWS:
+                    handle.write(b"\n".join(lines) + b"\n")
+                    lines.clear()
+            if lines:
+                handle.write(b"\n".join(lines) + b"\n")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        rows.close()
 
     return 0
 
@@ -0,0 +1,109 @@
+import datetime
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from aou_pheno_cc.cli import createphenodb
+
+
+def test_write_batches_to_sqlite(tmp_path: Path) -> None:
+    batches = [
+        pa.record_batch(
+            {
+                "person_id": pa.array([1, 2], pa.int64()),
+                "dob": pa.array([datetime.date(1980, 1, 1), None], pa.date32()),
+                "sex_at_birth": ["Male", "Female"],
+            }
+        ),
+        pa.record_batch(
+            {
+                "person_id": pa.array([3], pa.int64()),
+                "dob": pa.array([datetime.date(1990, 6, 1)], pa.date32()),
+                "sex_at_birth": ["Female"],
+            }
+        ),
+    ]
+    tsv_path = tmp_path / "demographics.tsv"
+    con = sqlite3.connect(tmp_path / "OMOP.db")
+    try:
+        createphenodb._write_batches_to_sqlite(con, "demographics", batches, tsv_path)
+        rows = con.execute(
+            "SELECT person_id, dob, sex_at_birth FROM demographics ORDER BY person_id"
+        ).fetchall()
+    finally:
+        con.close()
+
+    assert rows == [
+        (1, "1980-01-01", "Male"),
+        (2, None, "Female"),
+        (3, "1990-06-01", "Female"),
+    ]
+    tsv = pd.read_csv(tsv_path, sep="\t")
+    assert list(tsv.columns) == ["person_id", "dob", "sex_at_birth"]
+    assert tsv["person_id"].tolist() == [1, 2, 3]
+
+
+def test_tsv_quotes_strings_consistently(tmp_path: Path) -> None:
+    batches = [
+        pa.record_batch(
+            {
+                "person_id": pa.array([1, 2], pa.int64()),
+                "has_ehr_data": pa.array([True, False]),
+                "descendant_name": ["Asthma, mild", "Cough"],
+            }
+        ),
+        pa.record_batch(
+            {
+                "person_id": pa.array([3], pa.int64()),
+                "has_ehr_data": pa.array([True]),
+                "descendant_name": ['Type "2"\tdiabetes'],
+            }
+        ),
+    ]
+    tsv_path = tmp_path / "demographics.tsv"
+    con = sqlite3.connect(tmp_path / "OMOP.db")
+    try:
+        createphenodb._write_batches_to_sqlite(con, "demographics", batches, tsv_path)
+    finally:
+        con.close()
+
+    lines = tsv_path.read_text().splitlines()
+    assert lines == [
+        "person_id\thas_ehr_data\tdescendant_name",
+        '1\t"True"\t"Asthma, mild"',
+        '2\t"False"\t"Cough"',
+        '3\t"True"\t"Type ""2""\tdiabetes"',
+    ]
+    tsv = pd.read_csv(tsv_path, sep="\t")
+    assert tsv["has_ehr_data"].tolist() == [True, False, True]
+    assert tsv["descendant_name"].tolist() == ["Asthma, mild", "Cough", 'Type "2"\tdiabetes']
+
+
+def test_read_ancestry_local(tmp_path: Path) -> None:
+    src = tmp_path / "ancestry_preds.tsv"
+    src.write_text(
+        "research_id\tancestry_pred\tancestry_pred_other\n"
+        "1\teur\teur\n"
+        "2\tafr\toth\n"
+    )
+    tsv_path = tmp_path / "ancestry.tsv"
+
+    ancestry = createphenodb._read_ancestry(str(src), "project", tsv_path)
+
+    assert ancestry.column_names == ["person_id", "ancestry_pred"]
+    assert ancestry.column("person_id").to_pylist() == [1, 2]
+    assert ancestry.column("ancestry_pred").to_pylist() == ["eur", "afr"]
+    assert tsv_path.exists()
+
+
+def test_join_ancestry_keeps_unmatched_persons() -> None:
+    batch = pa.record_batch({"person_id": pa.array([1, 3], pa.int64()), "has_ehr_data": [1, 0]})
+    ancestry = pa.table({"person_id": pa.array([1, 2], pa.int64()), "ancestry_pred": ["eur", "afr"]})
+
+    joined = pa.Table.from_batches(list(createphenodb._join_ancestry([batch], ancestry)))
+
+    assert joined.column_names == ["person_id", "has_ehr_data", "ancestry_pred"]
+    rows = sorted(zip(joined.column("person_id").to_pylist(), joined.column("ancestry_pred").to_pylist()))
+    assert rows == [(1, "eur"), (3, None)]
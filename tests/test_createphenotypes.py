@@ -12,7 +12,10 @@ def _write_table(con: sqlite3.Connection, name: str, df: pd.DataFrame) -> None:
     df.to_sql(name, con, if_exists="replace", index=False)
 
 
-def test_createphenotypes_simple(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+@pytest.mark.parametrize("duplicate_demographics", [False, True])
+def test_createphenotypes_simple(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, duplicate_demographics: bool
+) -> None:
     db_path = tmp_path / "OMOP.db"
     con = sqlite3.connect(db_path)
     try:
@@ -27,13 +30,18 @@ def test_createphenotypes_simple(tmp_path: Path, monkeypatch: pytest.MonkeyPatch
                 "ancestry_pred": ["EUR", None, "AFR", "EUR"],
             }
         )
+        if duplicate_demographics:
+            # A duplicated ancestry row duplicates the person in demographics.
+            demographics = pd.concat([demographics, demographics.iloc[[2]]], ignore_index=True)
         _write_table(con, "demographics", demographics)
 
         condition_occurrence = pd.DataFrame(
             {
                 "person_id": [1, 3],
                 "condition_concept_id": [100, 100],
-                "condition_start_date": ["2000-01-01", "2010-01-01"],
+                "min_date": ["2000-01-01", "2010-01-01"],
+                "max_date": ["2000-01-01", "2012-06-01"],
+                "n_dates": [1, 3],
             }
         )
         _write_table(con, "condition_occurrence", condition_occurrence)
@@ -42,7 +50,9 @@ def test_createphenotypes_simple(tmp_path: Path, monkeypatch: pytest.MonkeyPatch
             {
                 "person_id": [],
                 "procedure_concept_id": [],
-                "procedure_date": [],
+                "min_date": [],
+                "max_date": [],
+                "n_dates": [],
             }
         )
         _write_table(con, "procedure_occurrence", procedure_occurrence)
@@ -134,3 +144,13 @@ def test_createphenotypes_simple(tmp_path: Path, monkeypatch: pytest.MonkeyPatch
     assert row["ancestry"] == "AFR"
     assert row["ncases"] == "<20"
     assert row["ncontrols"] == "<20"
+
+
+def test_group_rows_gathers_csr_ranges() -> None:
+    keys, offsets = createphenotypes._group_offsets([10, 10, 20, 30, 30, 30])
+    assert keys.tolist() == [10, 20, 30]
+    assert offsets.tolist() == [0, 2, 3, 6]
+
+    rows = createphenotypes._group_rows(keys, offsets, [30, 15, 10])
+    assert rows.tolist() == [3, 4, 5, 0, 1]
+    assert createphenotypes._group_rows(keys, offsets, []).tolist() == []
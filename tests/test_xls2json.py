@@ -3,6 +3,7 @@ from pathlib import Path
 
 import pandas as pd
 import pytest
+from openpyxl import Workbook
 
 from aou_pheno_cc.cli import xls2json
 
@@ -91,3 +92,125 @@ def test_xls2json_rejects_unknown_columns(tmp_path: Path, monkeypatch: pytest.Mo
     )
     with pytest.raises(ValueError, match="Unknown columns"):
         xls2json.main()
+
+
+def test_xls2json_rejects_duplicate_columns(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["phenotype_id", "phenotype_name", "case.cond", "case.cond"])
+    sheet.append(["ph1", "Phenotype 1", "1", "2"])
+    xlsx_path = tmp_path / "phenos.xlsx"
+    workbook.save(xlsx_path)
+
+    out_path = tmp_path / "phenos.jsonl"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["xls2json", str(xlsx_path), "--output", str(out_path)],
+    )
+    with pytest.raises(ValueError, match="Duplicate columns: case.cond"):
+        xls2json.main()
+
+
+def test_xls2json_skips_blank_rows(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    data = {
+        "phenotype_id": ["ph1", None, "ph2"],
+        "phenotype_name": ["Phenotype 1", None, "Phenotype 2"],
+        "case.cond": ["100", "not-a-concept", "200"],
+    }
+    df = pd.DataFrame(data)
+    xlsx_path = tmp_path / "phenos.xlsx"
+    df.to_excel(xlsx_path, index=False)
+
+    out_path = tmp_path / "phenos.jsonl"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["xls2json", str(xlsx_path), "--output", str(out_path)],
+    )
+    assert xls2json.main() == 0
+
+    records = [json.loads(line) for line in out_path.read_text().splitlines()]
+    assert [record["phenotype_id"] for record in records] == ["ph1", "ph2"]
+    assert [record["case.cond"] for record in records] == [[100], [200]]
+
+
+def test_xls2json_reports_all_invalid_concept_rows(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    data = {
+        "phenotype_id": ["ph1", "ph2", "ph3"],
+        "phenotype_name": ["Phenotype 1", "Phenotype 2", "Phenotype 3"],
+        "case.cond": ["100, x2", "200", "300,, 4 5"],
+    }
+    df = pd.DataFrame(data)
+    xlsx_path = tmp_path / "phenos.xlsx"
+    df.to_excel(xlsx_path, index=False)
+
+    out_path = tmp_path / "phenos.jsonl"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["xls2json", str(xlsx_path), "--output", str(out_path)],
+    )
+    with pytest.raises(ValueError, match=r"case\.cond \(rows 2, 4\): 'x2', '4 5'"):
+        xls2json.main()
+
+
+def test_xls2json_jobs_matches_serial(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    data = {
+        "phenotype_id": [f"ph{i}" for i in range(50)],
+        "phenotype_name": [f"Phenotype {i}" for i in range(50)],
+        "case.cond": [f"{i}, {i + 1}" for i in range(50)],
+        "case.cond.icd": ["A01, B02"] * 50,
+        "case.min.age": [30] * 50,
+    }
+    df = pd.DataFrame(data)
+    xlsx_path = tmp_path / "phenos.xlsx"
+    df.to_excel(xlsx_path, index=False)
+
+    outputs = []
+    for jobs in ("1", "4"):
+        out_path = tmp_path / f"phenos_{jobs}.jsonl"
+        monkeypatch.setattr(
+            "sys.argv",
+            ["xls2json", str(xlsx_path), "--output", str(out_path), "--jobs", jobs],
+        )
+        assert xls2json.main() == 0
+        outputs.append(out_path.read_bytes())
+
+    assert outputs[0] == outputs[1]
+    assert len(outputs[0].splitlines()) == 50
+
+
+def test_xls2json_rejects_zero_jobs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        "sys.argv",
+        ["xls2json", str(tmp_path / "phenos.xlsx"), "--jobs", "0"],
+    )
+    with pytest.raises(SystemExit) as excinfo:
+        xls2json.main()
+    assert excinfo.value.code == 2
+
+
+def test_xls2json_treats_na_tokens_as_missing(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["phenotype_id", "phenotype_name", "case.cond", "case.cond.icd", "case.min.age"])
+    sheet.append(["ph1", "Phenotype 1", "100, 200", "NA", "NA"])
+    sheet.append(["NA", "NA", None, None, None])
+    xlsx_path = tmp_path / "phenos.xlsx"
+    workbook.save(xlsx_path)
+
+    out_path = tmp_path / "phenos.jsonl"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["xls2json", str(xlsx_path), "--output", str(out_path)],
+    )
+    assert xls2json.main() == 0
+
+    records = [json.loads(line) for line in out_path.read_text().splitlines()]
+    assert len(records) == 1
+    assert records[0]["phenotype_id"] == "ph1"
+    assert records[0]["case.cond"] == [100, 200]
+    assert records[0]["case.cond.icd"] == []
+    assert records[0]["case.min.age"] is None